@@ -4,15 +4,26 @@ import argparse
 import csv
 import datetime
 import dateutil.parser
+import gzip
+import hashlib
+import io
 import json
 import matplotlib.pyplot as plt
 import matplotlib.dates
 import os
 import pandas
+import pickle
+import PIL.Image
+import random
 import re
 import requests
+import subprocess
 import sys
+import tarfile
+import tempfile
+import time
 import tkinter as tk  # sudo apt-get install python3-tk
+import zipfile
 from collections import defaultdict
 
 
@@ -27,7 +38,11 @@ def main():
     # DATA SOURCE OPTIONS
 
     parser.add_argument(
-        "--source", dest="source", default="jhu", help="jhu or wake", required=False
+        "--source",
+        dest="source",
+        default="jhu",
+        help="wake, or one of the JHU loaders: %s" % ", ".join(sorted(JHU_ENGINES)),
+        required=False,
     )
     parser.add_argument(
         "--jhu-data-dir",
@@ -90,6 +105,66 @@ def main():
         required=False,
     )
 
+    # RANKING OPTIONS
+
+    parser.add_argument(
+        "--top",
+        dest="top",
+        type=int,
+        default=None,
+        help="rank locations and print (or with --bulk, chart) the top N",
+        required=False,
+    )
+    parser.add_argument(
+        "--rank-by",
+        dest="rank-by",
+        default="avg-cases",
+        choices=sorted(RANK_METRICS.keys()),
+        help="metric used by --top (as of --end-date)",
+        required=False,
+    )
+    parser.add_argument(
+        "--level",
+        dest="level",
+        default="county",
+        choices=LOCATION_LEVELS,
+        help="location level ranked by --top",
+        required=False,
+    )
+
+    # BULK SCHEDULING OPTIONS
+
+    parser.add_argument(
+        "--order",
+        dest="order",
+        default="priority",
+        choices=["priority", "alpha"],
+        help="bulk order: world, countries, states, then counties (priority), or alphabetical",
+        required=False,
+    )
+    parser.add_argument(
+        "--order-file",
+        dest="order-file",
+        default=None,
+        help="bulk option: a file of locations (same format as --locations) to do first, in that order",
+        required=False,
+    )
+    parser.add_argument(
+        "--time-budget",
+        dest="time-budget",
+        type=float,
+        default=None,
+        help="bulk option: do not start any more locations after this many seconds",
+        required=False,
+    )
+    parser.add_argument(
+        "--pending-file",
+        dest="pending-file",
+        default=None,
+        help="bulk option: save locations not done within --time-budget here (usable as --filters)",
+        required=False,
+    )
+
     # CHART OPTIONS
 
     parser.add_argument(
@@ -122,6 +197,29 @@ def main():
         help="print list of valid combinations of country, state, county",
         required=False,
     )
+    parser.add_argument(
+        "--search",
+        dest="search",
+        default=None,
+        help="with --locations: only locations containing this text (^text = starting with it)",
+        required=False,
+    )
+    parser.add_argument(
+        "--location-details",
+        dest="location-details",
+        default=False,
+        action="store_true",
+        help="with --locations: also print first and last report dates and number of sub-divisions",
+        required=False,
+    )
+    parser.add_argument(
+        "--catalog",
+        dest="catalog",
+        default=None,
+        help="file that remembers the JHU locations, so --locations does not have to read every report "
+        "(default: kept with the JHU data)",
+        required=False,
+    )
     parser.add_argument(
         "--bulk",
         dest="bulk",
@@ -137,6 +235,22 @@ def main():
         help="output option: save one graph to file with this filename",
         required=False,
     )
+    parser.add_argument(
+        "--export-json",
+        dest="export-json",
+        action="store_true",
+        default=False,
+        help="bulk option: save compact JSON data for viewer/index.html instead of PNGs",
+        required=False,
+    )
+    parser.add_argument(
+        "--sink",
+        dest="sink",
+        default="files",
+        choices=["files", "tar", "zip", "cas"],
+        help="bulk output: individual files, one tar/zip archive, or content-addressed dir",
+        required=False,
+    )
 
     # IMAGE FORMATTING OPTIONS
 
@@ -151,6 +265,76 @@ def main():
     parser.add_argument(
         "--dpi", dest="dpi", type=int, default=None, help="dots per inch", required=False
     )
+    parser.add_argument(
+        "--downsample",
+        dest="downsample",
+        action="store_true",
+        default=False,
+        help="draw at most about 2 points per pixel column, keeping the peaks",
+        required=False,
+    )
+    parser.add_argument(
+        "--format",
+        dest="format",
+        default=None,
+        choices=sorted(IMAGE_FORMATS.keys()),
+        help="image format (png8 = indexed-palette PNG), default png",
+        required=False,
+    )
+    parser.add_argument(
+        "--zlib-level",
+        dest="zlib-level",
+        type=int,
+        default=None,
+        choices=range(10),
+        help="PNG compression level, 0 (none) to 9 (smallest)",
+        required=False,
+    )
+    parser.add_argument(
+        "--webp-quality",
+        dest="webp-quality",
+        type=int,
+        default=None,
+        choices=range(101),
+        metavar="0-100",
+        help="lossy WebP quality 0-100, default lossless",
+        required=False,
+    )
+    parser.add_argument(
+        "--compare-formats",
+        dest="compare-formats",
+        action="store_true",
+        default=False,
+        help="also encode every chart in every format, and report sizes and times",
+        required=False,
+    )
+
+    # VERIFICATION
+
+    parser.add_argument(
+        "--verify",
+        dest="verify",
+        default=None,
+        choices=sorted(x for x in JHU_ENGINES if x != "jhu"),
+        help="compare this JHU loader against the reference loader (jhu) and report differences",
+        required=False,
+    )
+    parser.add_argument(
+        "--verify-synthetic",
+        dest="verify-synthetic",
+        action="store_true",
+        default=False,
+        help="verify using generated daily reports instead of --jhu-data-dir",
+        required=False,
+    )
+    parser.add_argument(
+        "--verify-max-diffs",
+        dest="verify-max-diffs",
+        type=int,
+        default=20,
+        help="stop after reporting this many differences",
+        required=False,
+    )
 
     # DEBUG
 
@@ -169,12 +353,16 @@ def main():
     debug = args.pop("debug")
     print("debug = %d" % debug)
 
-    read_data_and_generate_charts(args)
+    if args["verify"]:
+        verify_engine(args)
+    else:
+        read_data_and_generate_charts(args)
 
 
 def read_data_and_generate_charts(args):
 
     all_loc_data = None
+    catalog = None
     location_key = None
 
     # CHART FILTERS
@@ -194,8 +382,16 @@ def read_data_and_generate_charts(args):
         county_filter = "Wake"
         location_key = join_location_key(country_filter, state_filter, county_filter)
         all_loc_data = get_wake_data(location_key)
-    elif source == "jhu":
-        all_loc_data = get_jhu_data(args.pop("jhu-data-dir"))
+    elif source in JHU_ENGINES:
+        jhu_data_dir = args.pop("jhu-data-dir")
+        catalog_file, signature = get_catalog_file_and_signature(source, jhu_data_dir)
+        catalog_file = args["catalog"] or catalog_file
+        catalog = load_location_catalog(catalog_file, signature)
+        # Listing locations only needs the catalog, if it is up to date.
+        if not (args["locations"] and catalog):
+            all_loc_data = JHU_ENGINES[source](jhu_data_dir)
+            if not catalog:
+                catalog = save_location_catalog(catalog_file, signature, all_loc_data)
     else:
         exit_on_error("unknown source '%s'" % source)
 
@@ -205,6 +401,17 @@ def read_data_and_generate_charts(args):
         print(json.dumps(all_loc_data))
         print("")
 
+    # LIST OF LOCATIONS
+
+    if args.pop("locations"):
+        if not catalog:
+            catalog = build_location_catalog(all_loc_data)
+        print_locations(
+            catalog, country_filter, state_filter, county_filter, recursive,
+            args.get("filters"), args.pop("search"), args.pop("location-details"),
+        )
+        return
+
     # COMPILE A LIST OF LOCATIONS THAT WE'RE INTERESTED IN
 
     filter_file = args.get("filters")
@@ -217,6 +424,25 @@ def read_data_and_generate_charts(args):
         )
     filtered_locations = sorted(filtered_locations)
 
+    # RANKING - REPLACES THE FILTERED LOCATIONS WITH THE TOP N AT ONE LEVEL
+
+    top = args.pop("top")
+    if top:
+        # Without filters, rank everything; with filters, rank within them.
+        candidates = filtered_locations
+        if not (filter_file or country_filter or state_filter or county_filter):
+            candidates = all_loc_data.keys()
+        ranking = rank_locations(
+            all_loc_data, candidates, args.pop("level"), args.pop("rank-by"), args["end-date"], args["avg"]
+        )
+        ranking = ranking.head(top)
+        print_ranking(ranking)
+        if not args["bulk"]:
+            return
+        filtered_locations = list(ranking.index)
+    else:
+        filtered_locations = schedule_locations(filtered_locations, args.pop("order"), args.pop("order-file"))
+
     # CHART OPTIONS
 
     new = args.pop("new")
@@ -228,18 +454,43 @@ def read_data_and_generate_charts(args):
     if args.pop("summary"):
         location_key = join_location_key(country_filter, state_filter, county_filter)
         summary(all_loc_data, location_key, args["end-date"])
-    elif args.pop("locations"):
-        location_strings = []
-        for location_key in sorted(all_loc_data.keys()):
-            print(location_key)
 
     # BULK PROCESSING OF ALL CHARTS MATCHING THE FILTERS
 
     elif args.pop("bulk"):
-        for index, location_key in enumerate(filtered_locations, 1):
-            country, state, county = split_location_key(location_key)
-            prefix = "location %d of %d" % (index, len(filtered_locations))
-            generate_chart_variants(all_loc_data, location_key, args, out, prefix=prefix)
+        sink_kind = args.pop("sink")
+        time_budget = args.pop("time-budget")
+        pending_file = args.pop("pending-file")
+        # An archive is written from scratch, so a later run cannot add the pending locations to it.
+        if sink_kind in ("tar", "zip") and (time_budget is not None or pending_file):
+            exit_on_error("--time-budget and --pending-file cannot be used with --sink=%s" % sink_kind)
+        sink = open_output_sink(sink_kind, out)
+        export_json = args.pop("export-json")
+        exported_locations = []
+        pending_locations = []
+        start_time = time.monotonic()
+        try:
+            for index, location_key in enumerate(filtered_locations, 1):
+                if time_budget is not None and time.monotonic() - start_time >= time_budget:
+                    pending_locations = filtered_locations[index - 1:]
+                    print("time budget of %s seconds used up, %d locations pending" % (time_budget, len(pending_locations)))
+                    break
+                prefix = "location %d of %d" % (index, len(filtered_locations))
+                if export_json:
+                    if export_location_json(all_loc_data, location_key, args["end-date"], sink, prefix=prefix):
+                        exported_locations.append(location_key)
+                else:
+                    generate_chart_variants(all_loc_data, location_key, args, sink, prefix=prefix)
+            if export_json:
+                export_json_index(exported_locations, sink)
+        finally:
+            sink.close()
+        if pending_file:
+            # Always rewrite it, so that a run that finishes everything leaves nothing pending.
+            with open(pending_file, "w") as file_obj:
+                for location_key in pending_locations:
+                    print(location_key, file=file_obj)
+        print_encode_stats()
 
     # SINGLE CHART - FILTERS SHOULD NARROW IT DOWN TO A SINGLE LOCATION
 
@@ -300,6 +551,204 @@ def filter_locations_from_file(all_loc_data, filter_file, recursive):
     return filtered_locations
 
 
+# ----- LOCATIONS - CATALOG -----
+
+# The catalog is saved (with the JHU data, see get_catalog_file_and_signature) whenever the JHU reports are read, as JSON:
+#   {"signature": "...", "locations": {"US|North Carolina|*":
+#       {"first": "2020-03-03", "last": "2021-01-05", "parent": "US|*|*", "children": 102}, ...}}
+# The signature changes whenever a report is added, removed or rewritten,
+# and a catalog with the wrong signature is ignored.
+
+def get_parent_location_key(location_key):
+    country, state, county = split_location_key(location_key)
+    if county:
+        return join_location_key(country, state, None)
+    if state:
+        return join_location_key(country, None, None)
+    if country:
+        return join_location_key(None, None, None)
+    return None
+
+
+CATALOG_FILE_NAME = ".covid-chart-location-catalog.json"
+
+
+def get_catalog_file_and_signature(source, git_root):
+    if source in JHU_GIT_ENGINES:
+        # These read HEAD, which need not be checked out (or the repo may be bare), so the catalog
+        # goes in the git directory and is keyed on the id of the reports tree at HEAD.
+        git_dir = run_git(git_root, "rev-parse", "--absolute-git-dir").decode().strip()
+        tree_id = run_git(git_root, "rev-parse", "HEAD:" + JHU_REPORTS_DIR).decode().strip()
+        return os.path.join(git_dir, CATALOG_FILE_NAME), "tree " + tree_id
+    return get_default_catalog_file(git_root), get_jhu_reports_signature(git_root)
+
+
+def get_default_catalog_file(git_root):
+    # Inside the JHU repo's .git directory (like the jhu-git blob cache),
+    # or else in the reports directory itself.
+    git_dir = os.path.join(git_root, ".git")
+    if os.path.isdir(git_dir):
+        return os.path.join(git_dir, CATALOG_FILE_NAME)
+    return os.path.join(get_jhu_reports_dir(git_root), CATALOG_FILE_NAME)
+
+
+def get_jhu_reports_signature(git_root):
+    # Names, sizes and modification times of the report files - no need to read them.
+    signature = hashlib.sha1(os.path.abspath(git_root).encode())
+    for entry in sorted(os.scandir(get_jhu_reports_dir(git_root)), key=lambda x: x.name):
+        # The catalog itself may be in the reports directory.
+        if entry.name.startswith(CATALOG_FILE_NAME):
+            continue
+        stat = entry.stat()
+        signature.update(("%s %d %d\n" % (entry.name, stat.st_size, stat.st_mtime_ns)).encode())
+    return signature.hexdigest()
+
+
+def build_location_catalog(all_loc_data):
+    catalog = {}
+    for location_key, dates in all_loc_data.items():
+        catalog[location_key] = {
+            "first": min(dates, default=None),
+            "last": max(dates, default=None),
+            "parent": get_parent_location_key(location_key),
+            "children": 0,
+        }
+    for location_key, entry in catalog.items():
+        if entry["parent"] in catalog:
+            catalog[entry["parent"]]["children"] += 1
+    return catalog
+
+
+def load_location_catalog(catalog_file, signature):
+    try:
+        with open(catalog_file) as file_obj:
+            saved = json.load(file_obj)
+    except (OSError, ValueError):
+        return None
+    if saved.get("signature") != signature:
+        if debug:
+            print("location catalog %s is out of date" % catalog_file)
+        return None
+    return saved["locations"]
+
+
+def save_location_catalog(catalog_file, signature, all_loc_data):
+    catalog = build_location_catalog(all_loc_data)
+    saved = {"signature": signature, "locations": catalog}
+    text = json.dumps(saved, separators=(",", ":"), sort_keys=True)
+    # Leave the file alone if nothing changed.
+    try:
+        with open(catalog_file) as file_obj:
+            if file_obj.read() == text:
+                return catalog
+    except OSError:
+        pass
+    try:
+        with open(catalog_file + ".tmp", "w") as file_obj:
+            file_obj.write(text)
+        os.replace(catalog_file + ".tmp", catalog_file)
+    except OSError as e:
+        print("could not save location catalog: %s" % e)
+    return catalog
+
+
+def print_locations(catalog, country_filter, state_filter, county_filter, recursive, filter_file, search, details):
+    if filter_file:
+        location_keys = filter_locations_from_file(catalog, filter_file, recursive)
+    elif country_filter or state_filter or county_filter:
+        location_keys = filter_locations_by_costco(catalog, country_filter, state_filter, county_filter, recursive)
+    else:
+        location_keys = catalog.keys()
+    if search:
+        if search.startswith("^"):
+            location_keys = [x for x in location_keys if x.lower().startswith(search[1:].lower())]
+        else:
+            location_keys = [x for x in location_keys if search.lower() in x.lower()]
+    for location_key in sorted(set(location_keys)):
+        if details:
+            entry = catalog[location_key]
+            print("%s  %s ~ %s  %d sub-divisions" % (location_key, entry["first"], entry["last"], entry["children"]))
+        else:
+            print(location_key)
+
+
+# ----- LOCATIONS - RANKING -----
+
+LOCATION_LEVELS = ["world", "country", "state", "county"]
+
+# Each metric is computed from a table with one row per date and one column per location.
+# new = daily differences, avg = the sliding average of those, cum = the cumulative counts.
+RANK_METRICS = {
+    "new-cases": lambda cum, new, avg: new.iloc[-1],
+    "avg-cases": lambda cum, new, avg: avg.iloc[-1],
+    "growth": lambda cum, new, avg: new.iloc[-7:].sum() / new.iloc[-14:-7].sum(),
+    "cases": lambda cum, new, avg: cum.iloc[-1],
+    "new-deaths": lambda cum, new, avg: new.iloc[-1],
+    "avg-deaths": lambda cum, new, avg: avg.iloc[-1],
+    "deaths": lambda cum, new, avg: cum.iloc[-1],
+}
+
+
+def get_location_level(location_key):
+    country, state, county = split_location_key(location_key)
+    return LOCATION_LEVELS[len(list(filter(None, (country, state, county))))]
+
+
+def rank_locations(all_loc_data, candidates, level, metric, end_date_str, moving_average):
+    # One table for every candidate location, so the metric is computed for all of them at once.
+    column = "deaths" if metric.endswith("deaths") else "cases"
+    locations = [x for x in candidates if get_location_level(x) == level]
+    table = pandas.DataFrame(
+        {location_key: {date_str: counts[column] for date_str, counts in all_loc_data[location_key].items()}
+         for location_key in locations}
+    )
+    if table.empty:
+        exit_on_error("no %s-level locations to rank" % level)
+    table = table.sort_index()
+    end_date = parse_date(end_date_str or "yesterday")
+    table = table[table.index <= end_date.isoformat()]
+    if table.empty:
+        exit_on_error("no data on or before %s" % end_date)
+    # A location missing from a daily report still has its previous count.
+    cum = table.ffill().fillna(0)
+    new = cum.diff()
+    avg = new.rolling(window=moving_average or 7).mean()
+    values = RANK_METRICS[metric](cum, new, avg)
+    # Growth from nothing is not a ranking.
+    values = values.replace([float("inf"), float("-inf")], float("nan")).dropna()
+    ranking = pandas.DataFrame({metric: values, "date": cum.index[-1]})
+    return ranking.sort_values(metric, ascending=False, kind="mergesort")
+
+
+def print_ranking(ranking):
+    metric = ranking.columns[0]
+    print("%4s  %12s  %-10s  %s" % ("rank", metric, "date", "location"))
+    for rank, (location_key, row) in enumerate(ranking.iterrows(), 1):
+        print("%4d  %12.2f  %-10s  %s" % (rank, row[metric], row["date"], location_key))
+
+
+# ----- LOCATIONS - SCHEDULING -----
+
+def schedule_locations(locations, order, order_file):
+    # Locations named in the order file come first, in the order given there.
+    # The rest are in priority order (the world, then countries, states and counties,
+    # since the charts at the top of the index pages are the ones that people look at),
+    # or alphabetical.
+    first = []
+    if order_file:
+        wanted = set(locations)
+        with open(order_file) as order_file_obj:
+            for line in order_file_obj:
+                location_key = line.strip()
+                if location_key in wanted:
+                    first.append(location_key)
+                    wanted.discard(location_key)
+    rest = sorted(set(locations) - set(first))
+    if order == "priority":
+        rest.sort(key=lambda location_key: LOCATION_LEVELS.index(get_location_level(location_key)))
+    return first + rest
+
+
 # ----- LOCATIONS - SPLITTING, JOINING AND FORMATTING -----
 
 def get_location_string(location_key):
@@ -349,7 +798,18 @@ def get_location_dataframe(datadict, location_data_index):
     )
 
 
-def summary(datadict, location_key, end_date_str, outfile=None):
+def summary(datadict, location_key, end_date_str, outfile=None, sink=None):
+    output = get_summary_text(datadict, location_key, end_date_str)
+    if sink:
+        sink.write(outfile, (output + "\n").encode())
+    elif outfile:
+        with open(outfile, "w") as file_obj:
+            print(output, file=file_obj)
+    else:
+        print(output)
+
+
+def get_summary_text(datadict, location_key, end_date_str):
     country, state, county = split_location_key(location_key)
     output = ""
     output += "country: %s\n" % (country or "ALL")
@@ -366,26 +826,20 @@ def summary(datadict, location_key, end_date_str, outfile=None):
         output += "date: %s\n" % data.dates.iat[-1].strftime("%Y-%m-%d")
         output += "cases: %s\n" % data.cases.iat[-1]
         output += "deaths: %s\n" % data.deaths.iat[-1]
-    if outfile:
-        with open(outfile, "w") as file_obj:
-            print(output, file=file_obj)
-    else:
-        print(output)
+    return output
 
 
-def generate_chart_variants(all_loc_data, location_key, args, out, prefix):
+def generate_chart_variants(all_loc_data, location_key, args, sink, prefix):
     # Generate charts for new deaths, new cases, cumulative deaths, cumulative cases.
-    generate_chart(all_loc_data, location_key, True, True, args, out, bulk=True, prefix=prefix)
-    generate_chart(all_loc_data, location_key, True, False, args, out, bulk=True, prefix=prefix)
-    generate_chart(all_loc_data, location_key, False, True, args, out, bulk=True, prefix=prefix)
-    generate_chart(all_loc_data, location_key, False, False, args, out, bulk=True, prefix=prefix)
+    for new, deaths in ((True, True), (True, False), (False, True), (False, False)):
+        generate_chart(all_loc_data, location_key, new, deaths, args, None, bulk=True, prefix=prefix, sink=sink)
     # Generate summary text.
-    summary_fullpath = build_full_file_path(out, location_key, "summary.txt")
-    print("%s %s" % (prefix, summary_fullpath))
-    summary(all_loc_data, location_key, args["end-date"], summary_fullpath)
+    summary_path = build_full_file_path(None, location_key, "summary.txt")
+    print("%s %s" % (prefix, sink.describe(summary_path)))
+    summary(all_loc_data, location_key, args["end-date"], summary_path, sink=sink)
 
 
-def generate_chart(datadict, location_key, new, deaths, format_opts, out, bulk=False, prefix=""):
+def generate_chart(datadict, location_key, new, deaths, format_opts, out, bulk=False, prefix="", sink=None):
 
     df1 = get_location_dataframe(datadict, location_key)
     if df1 is None:
@@ -469,6 +923,9 @@ def generate_chart(datadict, location_key, new, deaths, format_opts, out, bulk=F
         series_label += " (%s-day average)" % moving_average
     plt.suptitle(title, fontsize=18)
     subtitle = datetime.datetime.now().strftime("generated on %Y-%m-%d at %H:%M:%S")
+    if sink and sink.deterministic:
+        # The same data has to give the same bytes, so no generation time.
+        subtitle = "data through %s" % (df2.dates.max() if not df2.empty else end_date)
     plt.title(subtitle, fontsize=10)
     ax.set_ylabel(series_label)
 
@@ -480,20 +937,41 @@ def generate_chart(datadict, location_key, new, deaths, format_opts, out, bulk=F
     if format_opts["log"]:
         bar_chart = False
 
+    # Downsampling only changes what is drawn.  The Y limits below still use every data point.
+    plot_dates, plot_series = df2.dates, series
+    avg_dates, avg_series = df2.dates, None
+    bar_width = 1.0   # 0.8 causes "picket fence" effect
+    bar_align = "center"
+    if moving_average:
+        avg_series = series.rolling(window=moving_average).mean()
+    if format_opts["downsample"] and not df2.empty:
+        # One bucket per pixel column of the plot area.  The X axis runs from start_date to
+        # end_date, which can be well past the last data point, so buckets are date ranges.
+        days_per_bucket = max(1, (end_date - start_date).days) / max(1, ax.get_window_extent().width)
+        data_buckets = (df2.dates.iat[-1] - df2.dates.iat[0]).days / days_per_bucket + 1
+        if len(series) > 2 * data_buckets:
+            if debug:
+                print("downsampling %d data points into %d buckets" % (len(series), data_buckets))
+            plot_dates, plot_series = downsample(df2.dates, series, start_date, days_per_bucket, bar_chart)
+            bar_width = days_per_bucket
+            bar_align = "edge"
+            if moving_average:
+                avg_dates, avg_series = downsample(df2.dates, avg_series, start_date, days_per_bucket, False)
+
     if bar_chart:
         plt.bar(
-            df2.dates,
-            series,
-            width=1.0,   # 0.8 causes "picket fence" effect
+            plot_dates,
+            plot_series,
+            width=bar_width,
             bottom=None,
-            align="center",
+            align=bar_align,
             label=series_label,
             color=series_color,
         )
     else:
         plt.plot_date(
-            df2.dates,
-            series,
+            plot_dates,
+            plot_series,
             xdate=True,
             ydate=False,
             label=series_label,
@@ -502,8 +980,8 @@ def generate_chart(datadict, location_key, new, deaths, format_opts, out, bulk=F
         )
     if moving_average:
         plt.plot_date(
-            df2.dates,
-            series.rolling(window=moving_average).mean(),
+            avg_dates,
+            avg_series,
             xdate=True,
             ydate=False,
             label="%d-day average" % moving_average,
@@ -558,25 +1036,563 @@ def generate_chart(datadict, location_key, new, deaths, format_opts, out, bulk=F
         # Leave a little margin at the top.
         ax.set_ylim([0, ymax*1.05])
 
+    image_format = format_opts["format"] or "png"
     if bulk:
-        png_filename = "%s-%s.png" % (
+        image_filename = "%s-%s.%s" % (
             "new" if new else "cumulative",
             "deaths" if deaths else "cases",
+            IMAGE_FORMATS[image_format],
         )
-        png_fullpath = build_full_file_path(out, location_key, png_filename)
-        dirname = os.path.dirname(png_fullpath)
-        os.makedirs(dirname, exist_ok=True)
-        print("%s %s" % (prefix, png_fullpath))
-        plt.savefig(png_fullpath)
+        image_path = build_full_file_path(None, location_key, image_filename)
+        print("%s %s" % (prefix, sink.describe(image_path)))
+        if format_opts["compare-formats"]:
+            for other_format in sorted(IMAGE_FORMATS):
+                if other_format != image_format:
+                    encode_chart(fig, other_format, format_opts)
+        sink.write(image_path, encode_chart(fig, image_format, format_opts))
     elif not out:
         print("showing chart: %s" % title)
         plt.show()
-    else:
+    elif not format_opts["format"]:
+        # Let matplotlib pick the format from the file name.
         print("saving %s" % out)
         plt.savefig(out)
+    else:
+        print("saving %s" % out)
+        with open(out, "wb") as file_obj:
+            file_obj.write(encode_chart(fig, image_format, format_opts))
     plt.close("all")
 
 
+def downsample(dates, series, start_date, days_per_bucket, bar_chart):
+    # Split the series into buckets of days_per_bucket days each, counting from start_date.
+    # Bars keep the highest point in each bucket (one bar per bucket; bars below zero,
+    # like JHU corrections, are off the chart anyway), points and lines keep the lowest
+    # and highest points in each bucket.  Either way, every peak that would have been
+    # visible is still drawn.
+    dates = list(dates)
+    values = series.reset_index(drop=True)
+    valid = values.dropna()
+    bucket_ids = [int((dates[i] - start_date).days // days_per_bucket) for i in valid.index]
+    grouped = valid.groupby(bucket_ids)
+    if bar_chart:
+        # Each bar covers its whole bucket, starting where the bucket starts (see align="edge").
+        keep = list(grouped.idxmax())
+        start_time = datetime.datetime.combine(start_date, datetime.time())
+        bucket_starts = [
+            start_time + datetime.timedelta(days=bucket_id * days_per_bucket) for bucket_id in grouped.groups
+        ]
+        return bucket_starts, values[keep]
+    keep = sorted(set(grouped.idxmin()) | set(grouped.idxmax()))
+    return [dates[i] for i in keep], values[keep]
+
+
+# ----- JSON EXPORT FOR THE CLIENT-SIDE VIEWER -----
+
+# Each location's data is saved as data.json in the same place as its charts would be:
+#   {"key": "US|North Carolina|Wake", "start": "2020-03-22",
+#    "days": [0, 1, 1, ...], "cases": [1, 2, 0, ...], "deaths": [0, 0, 1, ...]}
+# All three lists are delta-encoded: each entry is the difference from the previous entry
+# (days since the previous report, new cases, new deaths), which keeps the numbers short.
+# index.json maps every exported location_key to the path of its data.json.
+
+def delta_encode(values):
+    previous = 0
+    deltas = []
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+    return deltas
+
+
+def export_location_json(datadict, location_key, end_date_str, sink, prefix=""):
+    df = get_location_dataframe(datadict, location_key)
+    if df is None:
+        exit_on_error("data frame was empty")
+    if end_date_str:
+        df = df[df.dates <= parse_date(end_date_str)]
+    if df.empty:
+        print("skipping location with no data: %s" % location_key)
+        return False
+    start_date = df.dates.iat[0]
+    days = [(date - start_date).days for date in df.dates]
+    data = {
+        "key": location_key,
+        "start": start_date.isoformat(),
+        "days": delta_encode(days),
+        "cases": delta_encode([int(x) for x in df.cases]),
+        "deaths": delta_encode([int(x) for x in df.deaths]),
+    }
+    json_path = build_full_file_path(None, location_key, "data.json")
+    print("%s %s" % (prefix, sink.describe(json_path)))
+    sink.write(json_path, json.dumps(data, separators=(",", ":")).encode())
+    return True
+
+
+def export_json_index(location_keys, sink):
+    # Keep the locations exported by earlier runs (e.g. before a --time-budget ran out).
+    index = {}
+    previous = sink.read("index.json")
+    if previous:
+        index.update(json.loads(previous))
+    for location_key in location_keys:
+        index[location_key] = build_full_file_path(None, location_key, "data.json")
+    print(sink.describe("index.json"))
+    sink.write("index.json", json.dumps(index, separators=(",", ":"), sort_keys=True).encode())
+
+
+# ----- IMAGE ENCODING -----
+
+# format name : file extension
+IMAGE_FORMATS = {
+    "png": "png",
+    "png8": "png",
+    "webp": "webp",
+    "svg": "svg",
+}
+
+# format name : [charts, bytes, seconds]
+encode_stats = defaultdict(lambda: [0, 0, 0.0])
+
+
+def encode_chart(fig, image_format, format_opts):
+    start_time = time.perf_counter()
+    buffer = io.BytesIO()
+    zlib_level = format_opts["zlib-level"]
+    if image_format == "svg":
+        # No date, and element ids that do not change from run to run.
+        with matplotlib.rc_context({"svg.hashsalt": "covid-chart"}):
+            fig.savefig(buffer, format="svg", metadata={"Date": None})
+    elif image_format == "png" and zlib_level is None:
+        fig.savefig(buffer, format="png")
+    else:
+        # Hand the rendered pixels to PIL, which has the encoder settings that matplotlib does not.
+        # Charts are drawn on an opaque background, so the alpha channel is dropped.
+        fig.canvas.draw()
+        image = PIL.Image.frombuffer(
+            "RGBA", fig.canvas.get_width_height(), fig.canvas.buffer_rgba(), "raw", "RGBA", 0, 1
+        ).convert("RGB")
+        if zlib_level is None:
+            zlib_level = 6
+        if image_format == "png":
+            image.save(buffer, format="PNG", compress_level=zlib_level)
+        elif image_format == "png8":
+            image = image.quantize(colors=256)
+            image.save(buffer, format="PNG", compress_level=zlib_level)
+        elif image_format == "webp":
+            quality = format_opts["webp-quality"]
+            if quality is None:
+                image.save(buffer, format="WEBP", lossless=True)
+            else:
+                image.save(buffer, format="WEBP", quality=quality)
+    data = buffer.getvalue()
+    stats = encode_stats[image_format]
+    stats[0] += 1
+    stats[1] += len(data)
+    stats[2] += time.perf_counter() - start_time
+    return data
+
+
+def print_encode_stats():
+    if not encode_stats:
+        return
+    print("%-6s  %8s  %14s  %12s" % ("format", "charts", "bytes/chart", "ms/chart"))
+    for image_format in sorted(encode_stats):
+        charts, total_bytes, total_seconds = encode_stats[image_format]
+        print(
+            "%-6s  %8d  %14d  %12.1f"
+            % (image_format, charts, total_bytes / charts, 1000 * total_seconds / charts)
+        )
+
+
+# ----- OUTPUT SINKS -----
+
+# Bulk runs write thousands of small files.  A sink decides where those bytes actually go:
+#   files = one file per chart in a country/state/county directory tree (the original layout)
+#   tar   = a single tar archive
+#   zip   = a single zip archive
+#   cas   = content-addressed objects (identical images stored once) plus a manifest of paths
+# All sinks take paths relative to the top of the output tree, as built by build_full_file_path(None, ...).
+
+SINK_BATCH_BYTES = 8 * 1024 * 1024
+
+
+def open_output_sink(kind, out):
+    if kind == "files":
+        return FileSink(out)
+    if not out:
+        exit_on_error("--sink=%s requires --out" % kind)
+    if kind in ("tar", "zip"):
+        return ArchiveSink(out, kind)
+    if kind == "cas":
+        return ContentAddressedSink(out)
+    exit_on_error("unknown sink '%s'" % kind)
+
+
+class FileSink:
+    deterministic = False
+
+    def __init__(self, top_dir):
+        self.top_dir = top_dir
+        self.made_dirs = set()
+
+    def describe(self, rel_path):
+        return "/".join(filter(None, (self.top_dir, rel_path)))
+
+    def write(self, rel_path, data):
+        full_path = self.describe(rel_path)
+        # Only ask the filesystem about each directory once.
+        dirname = os.path.dirname(full_path)
+        if dirname and dirname not in self.made_dirs:
+            os.makedirs(dirname, exist_ok=True)
+            self.made_dirs.add(dirname)
+        with open(full_path, "wb") as file_obj:
+            file_obj.write(data)
+
+    def read(self, rel_path):
+        try:
+            with open(self.describe(rel_path), "rb") as file_obj:
+                return file_obj.read()
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        pass
+
+
+class ArchiveSink:
+    # Entries are held in memory and written to the archive in large batches,
+    # through a file object with a buffer of the same size.
+    deterministic = False
+
+    def __init__(self, archive_path, kind):
+        if not archive_path.endswith("." + kind):
+            archive_path += "." + kind
+        self.archive_path = archive_path
+        self.kind = kind
+        self.pending = []
+        self.pending_bytes = 0
+        dirname = os.path.dirname(archive_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.file_obj = open(archive_path, "wb", buffering=SINK_BATCH_BYTES)
+        if kind == "tar":
+            self.archive = tarfile.open(fileobj=self.file_obj, mode="w")
+        else:
+            # Compression is chosen for each entry, see flush().
+            self.archive = zipfile.ZipFile(self.file_obj, mode="w", compression=zipfile.ZIP_STORED)
+
+    def describe(self, rel_path):
+        return "%s:%s" % (self.archive_path, rel_path)
+
+    def read(self, rel_path):
+        # Archives always start out empty.
+        return None
+
+    def write(self, rel_path, data):
+        self.pending.append((rel_path, data))
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= SINK_BATCH_BYTES:
+            self.flush()
+
+    def flush(self):
+        if debug:
+            print("writing %d entries (%d bytes) to %s" % (len(self.pending), self.pending_bytes, self.archive_path))
+        now = datetime.datetime.now()
+        for rel_path, data in self.pending:
+            if self.kind == "tar":
+                info = tarfile.TarInfo(rel_path)
+                info.size = len(data)
+                info.mtime = now.timestamp()
+                self.archive.addfile(info, io.BytesIO(data))
+            else:
+                info = zipfile.ZipInfo(rel_path, date_time=now.timetuple()[:6])
+                # PNG and WebP are already compressed, deflating them again buys nothing.
+                # Text, JSON and SVG shrink a lot.
+                if not rel_path.endswith((".png", ".webp")):
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                self.archive.writestr(info, data)
+        self.pending = []
+        self.pending_bytes = 0
+
+    def close(self):
+        self.flush()
+        self.archive.close()
+        self.file_obj.close()
+
+
+class ContentAddressedSink:
+    # Each distinct blob is stored once, as objects/ab/abcdef....  The manifest maps every
+    # output path to the hash of its contents, one "sha256<TAB>path" line per output, and
+    # every output path is a hard link to its object.  Charts leave out their generation time
+    # (see generate_chart), so a chart whose data has not changed is stored only once.
+    deterministic = True
+
+    def __init__(self, top_dir):
+        self.top_dir = top_dir
+        self.manifest = {}
+        self.pending = {}
+        self.pending_bytes = 0
+        self.made_dirs = set()
+        # Outputs from earlier runs stay in the manifest, unless this run replaces them.
+        try:
+            with open(self.manifest_path()) as file_obj:
+                for line in file_obj:
+                    digest, rel_path = line.rstrip("\n").split("\t", 1)
+                    if os.path.exists(self.object_path(digest)):
+                        self.manifest[rel_path] = digest
+        except FileNotFoundError:
+            pass
+
+    def manifest_path(self):
+        return "/".join([self.top_dir, "manifest.tsv"])
+
+    def describe(self, rel_path):
+        return "%s/manifest.tsv:%s" % (self.top_dir, rel_path)
+
+    def object_path(self, digest):
+        return "/".join([self.top_dir, "objects", digest[:2], digest])
+
+    def make_dirs(self, dirname):
+        if dirname not in self.made_dirs:
+            os.makedirs(dirname, exist_ok=True)
+            self.made_dirs.add(dirname)
+
+    def read(self, rel_path):
+        if rel_path in self.manifest:
+            digest = self.manifest[rel_path]
+            if digest in self.pending:
+                return self.pending[digest]
+            with open(self.object_path(digest), "rb") as file_obj:
+                return file_obj.read()
+        return None
+
+    def write(self, rel_path, data):
+        digest = hashlib.sha256(data).hexdigest()
+        self.manifest[rel_path] = digest
+        if digest in self.pending:
+            return
+        self.pending[digest] = data
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= SINK_BATCH_BYTES:
+            self.flush()
+
+    def flush(self):
+        stored = 0
+        for digest, data in self.pending.items():
+            object_path = self.object_path(digest)
+            self.make_dirs(os.path.dirname(object_path))
+            # Objects from earlier runs are already in place.
+            if os.path.exists(object_path):
+                continue
+            with open(object_path, "wb") as file_obj:
+                file_obj.write(data)
+            stored += 1
+        if debug:
+            print("stored %d new objects of %d pending in %s" % (stored, len(self.pending), self.top_dir))
+        self.pending = {}
+        self.pending_bytes = 0
+
+    def link(self):
+        linked = 0
+        for rel_path, digest in self.manifest.items():
+            full_path = "/".join([self.top_dir, rel_path])
+            object_path = self.object_path(digest)
+            if os.path.exists(full_path):
+                if os.path.samefile(full_path, object_path):
+                    continue
+                os.remove(full_path)
+            self.make_dirs(os.path.dirname(full_path))
+            os.link(object_path, full_path)
+            linked += 1
+        if debug:
+            print("linked %d outputs in %s" % (linked, self.top_dir))
+
+    def remove_unused_objects(self):
+        in_use = set(self.manifest.values())
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk("/".join([self.top_dir, "objects"])):
+            for filename in filenames:
+                if filename not in in_use:
+                    os.remove(os.path.join(dirpath, filename))
+                    removed += 1
+        return removed
+
+    def close(self):
+        self.flush()
+        self.link()
+        with open(self.manifest_path(), "w", buffering=SINK_BATCH_BYTES) as file_obj:
+            for rel_path in sorted(self.manifest):
+                file_obj.write("%s\t%s\n" % (self.manifest[rel_path], rel_path))
+        removed = self.remove_unused_objects()
+        print(
+            "%d outputs, %d distinct objects, %d unused objects removed"
+            % (len(self.manifest), len(set(self.manifest.values())), removed)
+        )
+
+
+# ----- VERIFICATION OF ALTERNATIVE LOADERS -----
+
+def verify_engine(args):
+    engine = args["verify"]
+    max_diffs = args["verify-max-diffs"]
+    if args["verify-synthetic"]:
+        with tempfile.TemporaryDirectory() as git_root:
+            write_synthetic_jhu_data(git_root)
+            differences = compare_engines("jhu", engine, git_root, args["end-date"], max_diffs)
+            if engine in JHU_GIT_ENGINES:
+                differences += compare_git_clones("jhu", engine, git_root, args["end-date"], max_diffs)
+    else:
+        differences = compare_engines("jhu", engine, args["jhu-data-dir"], args["end-date"], max_diffs)
+    if differences:
+        exit_on_error("%s differs from jhu (showing at most %d differences)" % (engine, max_diffs))
+    print("%s matches jhu" % engine)
+
+
+def compare_git_clones(reference_engine, engine, git_root, end_date_str, max_diffs):
+    # A git-backed engine, and its location catalog, must also work on clones with no checked-out reports.
+    differences = 0
+    for clone_option in ("--no-checkout", "--bare"):
+        with tempfile.TemporaryDirectory() as clone_root:
+            subprocess.run(["git", "clone", "-q", clone_option, git_root, clone_root], check=True)
+            print("%s clone:" % clone_option)
+            differences += compare_engines(reference_engine, engine, git_root, end_date_str, max_diffs, clone_root)
+            catalog_file, signature = get_catalog_file_and_signature(engine, clone_root)
+            save_location_catalog(catalog_file, signature, JHU_ENGINES[engine](clone_root))
+            expected = build_location_catalog(JHU_ENGINES[reference_engine](git_root))
+            if load_location_catalog(catalog_file, signature) != expected:
+                differences += 1
+                print("difference: %s location catalog in %s clone" % (engine, clone_option))
+    return differences
+
+
+def compare_engines(reference_engine, engine, git_root, end_date_str, max_diffs, engine_root=None):
+    # engine_root: where engine reads the reports from, if not git_root
+    reference_start = time.perf_counter()
+    reference = JHU_ENGINES[reference_engine](git_root)
+    engine_start = time.perf_counter()
+    other = JHU_ENGINES[engine](engine_root or git_root)
+    engine_end = time.perf_counter()
+    print("%s: %d locations in %.2f seconds" % (reference_engine, len(reference), engine_start - reference_start))
+    print("%s: %d locations in %.2f seconds" % (engine, len(other), engine_end - engine_start))
+
+    differences = 0
+
+    def report(message):
+        nonlocal differences
+        differences += 1
+        if differences <= max_diffs:
+            print("difference: %s" % message)
+        return differences >= max_diffs
+
+    # Per-location, per-date counts.
+    for location_key in sorted(set(reference) | set(other)):
+        if location_key not in reference or location_key not in other:
+            missing_from = engine if location_key in reference else reference_engine
+            if report("%s is missing from %s" % (location_key, missing_from)):
+                return differences
+            continue
+        reference_dates = reference[location_key]
+        other_dates = other[location_key]
+        for date_str in sorted(set(reference_dates) | set(other_dates)):
+            for count in ("cases", "deaths"):
+                reference_count = reference_dates[date_str][count] if date_str in reference_dates else None
+                other_count = other_dates[date_str][count] if date_str in other_dates else None
+                if reference_count != other_count:
+                    if report(
+                        "%s %s %s: %s=%s %s=%s"
+                        % (location_key, date_str, count, reference_engine, reference_count, engine, other_count)
+                    ):
+                        return differences
+
+    # The summary() text, which is what bulk runs publish.
+    if not end_date_str:
+        end_date_str = max(reference[join_location_key(None, None, None)], default="yesterday")
+    for location_key in sorted(set(reference) & set(other)):
+        reference_text = get_summary_text_or_error(reference, location_key, end_date_str)
+        other_text = get_summary_text_or_error(other, location_key, end_date_str)
+        if reference_text != other_text:
+            if report(
+                "%s summary:\n--- %s\n%s--- %s\n%s"
+                % (location_key, reference_engine, reference_text, engine, other_text)
+            ):
+                return differences
+    return differences
+
+
+def get_summary_text_or_error(datadict, location_key, end_date_str):
+    try:
+        return get_summary_text(datadict, location_key, end_date_str)
+    except Exception as e:
+        return "error: %r\n" % e
+
+
+def write_synthetic_jhu_data(git_root, days=40, seed=1):
+    # Daily reports in every historical format, with the awkward cases that the
+    # rollup rules have to handle: blank states and counties, repeated locations,
+    # non-numeric counts, names containing commas and byte-order marks.
+    rng = random.Random(seed)
+    dir_name = git_root + "/" + JHU_REPORTS_DIR
+    os.makedirs(dir_name)
+    locations = [
+        ("US", "North Carolina", "Wake"),
+        ("US", "North Carolina", "Durham"),
+        ("US", "North Carolina", "Unassigned"),
+        ("US", "North Carolina", ""),
+        ("US", "New York", "New York City"),
+        ("US", "", ""),
+        ("Japan", "Hokkaido", ""),
+        ("Japan", "", ""),
+        ("Korea, South", "", ""),
+        ("United Kingdom", "England", ""),
+        ("", "", ""),
+    ]
+    headers = [
+        "Province/State,Country/Region,Last Update,Confirmed,Deaths,Recovered",
+        "Province/State,Country/Region,Last Update,Confirmed,Deaths,Recovered,Latitude,Longitude",
+        "FIPS,Admin2,Province_State,Country_Region,Last_Update,Lat,Long_,Confirmed,Deaths,Recovered,Active,Combined_Key",
+    ]
+    totals = defaultdict(int)
+    start_date = datetime.date(2020, 1, 22)
+    for day in range(days):
+        date = start_date + datetime.timedelta(days=day)
+        header = headers[day * len(headers) // days]
+        lines = [header]
+        for country, state, county in locations:
+            # Some locations are missing from some reports, some appear twice.
+            for repeat in range(rng.choice([0, 1, 1, 1, 1, 2])):
+                totals[(country, state, county)] += rng.randint(0, 100)
+                cases = str(totals[(country, state, county)])
+                deaths = str(totals[(country, state, county)] // 30)
+                if rng.random() < 0.05:
+                    cases = rng.choice(["", "n/a", "12.0", " 7 "])
+                if rng.random() < 0.05:
+                    deaths = ""
+                if header.startswith("FIPS"):
+                    fields = ["", county, state, country, "", "", "", cases, deaths, "", "", ""]
+                else:
+                    # The old formats had no counties.
+                    if county:
+                        continue
+                    fields = [state, country, "", cases, deaths, ""]
+                    if "Latitude" in header:
+                        fields += ["", ""]
+                lines.append(",".join('"%s"' % x if "," in x else x for x in fields))
+        text = "\n".join(lines) + "\n"
+        if day % 7 == 3:
+            text = "\ufeff" + text
+        with open(os.path.join(dir_name, date.strftime("%m-%d-%Y.csv")), "w") as file_obj:
+            file_obj.write(text)
+    # Commit them, so that loaders which read the git object store see the same reports.
+    # The user's own git settings (signing, hooks) must not get in the way.
+    commit_args = [
+        "-c", "user.name=covid-chart", "-c", "user.email=covid-chart@localhost", "-c", "commit.gpgsign=false",
+        "commit", "-q", "--no-verify", "-m", "synthetic",
+    ]
+    for git_args in (["init", "-q"], ["add", "."], commit_args):
+        subprocess.run(["git", "-C", git_root] + git_args, check=True)
+
+
 # ----- UTILITY FUNCTIONS -----
 
 def exit_on_error(string):
@@ -600,96 +1616,288 @@ def parse_date(date_string):
 
 # ----- DATA SOURCES -----
 
-def get_jhu_data(git_root):
+# Formats of the JHU daily reports have changed over time:
+
+# first seen in COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/01-22-2020.csv
+# Province/State,Country/Region,Last Update,Confirmed,Deaths,Recovered
+# "Chicago, IL",US,2020-02-09T19:03:03,2,0,2
+# "San Benito, CA",US,2020-02-03T03:53:02,2,0,0
+
+# first seen in COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/03-01-2020.csv
+# Province/State,Country/Region,Last Update,Confirmed,Deaths,Recovered,Latitude,Longitude
+# Washington,US,2020-03-10T22:13:11,267,23,1,47.4009,-121.4905
+# New York,US,2020-03-10T17:13:27,173,0,0,42.1657,-74.9481
 
-    dir_name = git_root + "/csse_covid_19_data/csse_covid_19_daily_reports"
-
-    # Formats have changed over time:
-
-    # first seen in COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/01-22-2020.csv
-    # Province/State,Country/Region,Last Update,Confirmed,Deaths,Recovered
-    # "Chicago, IL",US,2020-02-09T19:03:03,2,0,2
-    # "San Benito, CA",US,2020-02-03T03:53:02,2,0,0
-
-    # first seen in COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/03-01-2020.csv
-    # Province/State,Country/Region,Last Update,Confirmed,Deaths,Recovered,Latitude,Longitude
-    # Washington,US,2020-03-10T22:13:11,267,23,1,47.4009,-121.4905
-    # New York,US,2020-03-10T17:13:27,173,0,0,42.1657,-74.9481
-
-    # first seen in COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/03-22-2020.csv
-    # FIPS,Admin2,Province_State,Country_Region,Last_Update,Lat,Long_,Confirmed,Deaths,Recovered,Active,Combined_Key
-    # 45001,Abbeville,South Carolina,US,2020-04-10 22:54:07,34.22333378,-82.46170658,7,0,0,0,"Abbeville, South Carolina, US"
-    # 22001,Acadia,Louisiana,US,2020-04-10 22:54:07,30.295064899999996,-92.41419698,94,4,0,0,"Acadia, Louisiana, US"
-
-    # first seen in COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/05-29-2020.csv
-    # FIPS,Admin2,Province_State,Country_Region,Last_Update,Lat,Long_,Confirmed,Deaths,Recovered,Active,Combined_Key,Incidence_Rate,Case-Fatality_Ratio
-    # 45001,Abbeville,South Carolina,US,2020-06-22 04:33:20,34.22333378,-82.46170658,88,0,0,88,"Abbeville, South Carolina, US",358.78827414685856,0.0
-
-    country_col = ["Country/Region", "Country_Region"]
-    state_col = ["Province/State", "Province_State"]
-    county_col = ["Admin2"]
-    cases_col = ["Confirmed"]
-    deaths_col = ["Deaths"]
-
-    def get_val_by_column_names(row, col_names, number=False):
-        for col_name in col_names:
-            if col_name in row:
-                val = row[col_name]
-                if number:
-                    try:
-                        val = int(val)
-                    except ValueError:
-                        val = 0
-                return val
-        if number:
-            return 0
+# first seen in COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/03-22-2020.csv
+# FIPS,Admin2,Province_State,Country_Region,Last_Update,Lat,Long_,Confirmed,Deaths,Recovered,Active,Combined_Key
+# 45001,Abbeville,South Carolina,US,2020-04-10 22:54:07,34.22333378,-82.46170658,7,0,0,0,"Abbeville, South Carolina, US"
+# 22001,Acadia,Louisiana,US,2020-04-10 22:54:07,30.295064899999996,-92.41419698,94,4,0,0,"Acadia, Louisiana, US"
+
+# first seen in COVID-19/csse_covid_19_data/csse_covid_19_daily_reports/05-29-2020.csv
+# FIPS,Admin2,Province_State,Country_Region,Last_Update,Lat,Long_,Confirmed,Deaths,Recovered,Active,Combined_Key,Incidence_Rate,Case-Fatality_Ratio
+# 45001,Abbeville,South Carolina,US,2020-06-22 04:33:20,34.22333378,-82.46170658,88,0,0,88,"Abbeville, South Carolina, US",358.78827414685856,0.0
+
+JHU_COUNTRY_COL = ["Country/Region", "Country_Region"]
+JHU_STATE_COL = ["Province/State", "Province_State"]
+JHU_COUNTY_COL = ["Admin2"]
+JHU_CASES_COL = ["Confirmed"]
+JHU_DEATHS_COL = ["Deaths"]
+
+
+JHU_REPORTS_DIR = "csse_covid_19_data/csse_covid_19_daily_reports"
+
+
+def get_report_date_str(file_name):
+    # "01-22-2020.csv", "01-22-2020.csv.gz", ... => "2020-01-22", or None if it is not a daily report
+    file_prefix = file_name.split(".")[0]
+    try:
+        csv_datetime = datetime.datetime.strptime(file_prefix, "%m-%d-%Y")
+    except ValueError:
         return None
+    return csv_datetime.strftime("%Y-%m-%d")
+
+
+def open_zstd(file_name):
+    try:
+        import zstandard
+    except ImportError:
+        exit_on_error("reading %s requires the zstandard package (pip install zstandard)" % file_name)
+    return zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"))
+
+
+JHU_ARCHIVE_RE = re.compile(r"\.(zip|tar|tgz|tar\.gz|tar\.bz2|tar\.xz|tar\.zst)$")
+
+
+def is_jhu_report_file(file_name):
+    # A daily report (maybe compressed), or an archive that may hold some.
+    if re.search(r"\.csv(\.gz|\.zst)?$", file_name) and get_report_date_str(file_name):
+        return True
+    return bool(JHU_ARCHIVE_RE.search(file_name))
+
+
+def get_jhu_reports_dir(git_root):
+    # Reports are in the JHU git layout, or directly in git_root (for a directory of archives).
+    dir_name = git_root + "/" + JHU_REPORTS_DIR
+    if os.path.isdir(dir_name):
+        return dir_name
+    if os.path.isdir(git_root) and any(is_jhu_report_file(x) for x in os.listdir(git_root)):
+        return git_root
+    exit_on_error("no JHU daily reports in %s or in %s" % (dir_name, git_root))
+
+
+def iter_jhu_reports(git_root):
+    # Yields (date_str, report name, text file object) for each daily report.
+    # Reports can be plain .csv files, compressed .csv.gz or .csv.zst files, or members of
+    # .zip or .tar (optionally .gz, .bz2, .xz or .zst compressed) archives.  Everything is
+    # decompressed as it is read, nothing is extracted to disk.  Each file object is only
+    # good until the next report is requested.
+    dir_name = get_jhu_reports_dir(git_root)
+    seen_dates = set()
+
+    def new_date(date_str, report_name):
+        if date_str is None:
+            if debug:
+                print("skipping %s, not a daily report" % report_name)
+            return False
+        if date_str in seen_dates:
+            print("skipping %s, already have a report for %s" % (report_name, date_str))
+            return False
+        seen_dates.add(date_str)
+        return True
+
+    def iter_tar(tar_file, file_name):
+        # Streaming mode: the members are read in archive order, in one pass.
+        for member in tar_file:
+            member_name = os.path.basename(member.name)
+            if member.isfile() and member_name.endswith(".csv"):
+                report_name = "%s:%s" % (file_name, member.name)
+                date_str = get_report_date_str(member_name)
+                if new_date(date_str, report_name):
+                    # Members of a streamed tar cannot be wrapped directly, but one report fits in memory.
+                    report = io.BytesIO(tar_file.extractfile(member).read())
+                    yield date_str, report_name, io.TextIOWrapper(report)
+
+    for file_name in sorted(os.listdir(dir_name)):
+        full_name = os.path.join(dir_name, file_name)
+        if file_name.endswith(".csv"):
+            if new_date(get_report_date_str(file_name), full_name):
+                with open(full_name) as csv_file_obj:
+                    yield get_report_date_str(file_name), full_name, csv_file_obj
+        elif file_name.endswith(".csv.gz"):
+            if new_date(get_report_date_str(file_name), full_name):
+                with gzip.open(full_name, "rt") as csv_file_obj:
+                    yield get_report_date_str(file_name), full_name, csv_file_obj
+        elif file_name.endswith(".csv.zst"):
+            if new_date(get_report_date_str(file_name), full_name):
+                with io.TextIOWrapper(open_zstd(full_name)) as csv_file_obj:
+                    yield get_report_date_str(file_name), full_name, csv_file_obj
+        elif file_name.endswith(".zip"):
+            with zipfile.ZipFile(full_name) as zip_file:
+                for member in sorted(zip_file.namelist()):
+                    member_name = os.path.basename(member)
+                    if member_name.endswith(".csv"):
+                        report_name = "%s:%s" % (full_name, member)
+                        date_str = get_report_date_str(member_name)
+                        if new_date(date_str, report_name):
+                            with io.TextIOWrapper(zip_file.open(member)) as csv_file_obj:
+                                yield date_str, report_name, csv_file_obj
+        elif file_name.endswith(".tar.zst"):
+            with open_zstd(full_name) as zstd_file, tarfile.open(fileobj=zstd_file, mode="r|") as tar_file:
+                yield from iter_tar(tar_file, full_name)
+        elif JHU_ARCHIVE_RE.search(file_name):
+            with tarfile.open(full_name, mode="r|*") as tar_file:
+                yield from iter_tar(tar_file, full_name)
+
+
+def get_val_by_column_names(row, col_names, number=False):
+    for col_name in col_names:
+        if col_name in row:
+            val = row[col_name]
+            if number:
+                try:
+                    val = int(val)
+                except ValueError:
+                    val = 0
+            return val
+    if number:
+        return 0
+    return None
+
+
+def ingest_jhu_report(csv_file_obj, date_str, results):
+    csv_dict_reader = csv.DictReader(csv_file_obj)
+    for row in csv_dict_reader:
+
+        csv_country = get_val_by_column_names(row, JHU_COUNTRY_COL)
+        csv_state = get_val_by_column_names(row, JHU_STATE_COL)
+        csv_county = get_val_by_column_names(row, JHU_COUNTY_COL)
+        csv_cases = get_val_by_column_names(row, JHU_CASES_COL, number=True)
+        csv_deaths = get_val_by_column_names(row, JHU_DEATHS_COL, number=True)
+
+        # Save values at all appropriate levels
+        location_keys = [
+            join_location_key(None, None, None),
+            join_location_key(csv_country, None, None),
+            join_location_key(csv_country, csv_state, None),
+            join_location_key(csv_country, csv_state, csv_county),
+        ]
+        # Do not add values to the same level twice.
+        for location_key in set(location_keys):
+            # location_key = join_location_key(*country_state_county)
+            results[location_key][date_str]["cases"] += csv_cases
+            results[location_key][date_str]["deaths"] += csv_deaths
+            if debug > 2:
+                print(
+                    "date=%s, location=%s, cases=%d, deaths=%d"
+                    % (date_str, location_key, csv_cases, csv_deaths)
+                )
+
+
+def get_jhu_data(git_root):
 
     # store all results in a multi-level dictionary, format:
     # results['US|North Carolina|Wake']['2020-07-03'] = { 'cases': 5000, 'deaths': 20 }
     results = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-    for file_name in sorted(os.listdir(dir_name)):
-        if file_name.endswith(".csv"):
-            file_prefix = file_name.split(".")[0]
-            csv_datetime = datetime.datetime.strptime(file_prefix, "%m-%d-%Y")
-            if not csv_datetime:
-                continue
-            date_str = csv_datetime.strftime("%Y-%m-%d")
-            csv_filename = os.path.join(dir_name, file_name)
-            with open(csv_filename) as csv_file_obj:
-                if debug:
-                    print("ingesting %s" % csv_filename)
-
-                csv_dict_reader = csv.DictReader(csv_file_obj)
-                for row in csv_dict_reader:
-
-                    csv_country = get_val_by_column_names(row, country_col)
-                    csv_state = get_val_by_column_names(row, state_col)
-                    csv_county = get_val_by_column_names(row, county_col)
-                    csv_cases = get_val_by_column_names(row, cases_col, number=True)
-                    csv_deaths = get_val_by_column_names(row, deaths_col, number=True)
-
-                    # Save values at all appropriate levels
-                    location_keys = [
-                        join_location_key(None, None, None),
-                        join_location_key(csv_country, None, None),
-                        join_location_key(csv_country, csv_state, None),
-                        join_location_key(csv_country, csv_state, csv_county),
-                    ]
-                    # Do not add values to the same level twice.
-                    for location_key in set(location_keys):
-                        # location_key = join_location_key(*country_state_county)
-                        results[location_key][date_str]["cases"] += csv_cases
-                        results[location_key][date_str]["deaths"] += csv_deaths
-                        if debug > 2:
-                            print(
-                                "date=%s, location=%s, cases=%d, deaths=%d"
-                                % (date_str, location_key, csv_cases, csv_deaths)
-                            )
+    for date_str, report_name, csv_file_obj in iter_jhu_reports(git_root):
+        if debug:
+            print("ingesting %s" % report_name)
+        ingest_jhu_report(csv_file_obj, date_str, results)
+
+    return results
+
 
+# Change this whenever ingest_jhu_report (or anything it uses) would count a report differently,
+# so that get_jhu_data_git throws away counts cached by the old code.
+JHU_BLOB_CACHE_VERSION = 1
+
+
+def run_git(git_root, *git_args):
+    try:
+        return subprocess.run(["git", "-C", git_root] + list(git_args), check=True, stdout=subprocess.PIPE).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        exit_on_error("git failed in %s: %s" % (git_root, e))
+
+
+def get_jhu_data_git(git_root):
+
+    # Reads the daily reports from the git object store at HEAD, rather than from the checked-out files.
+    # Each report's rolled-up counts are cached (in the .git directory) by blob SHA, so after a
+    # `git pull` only the reports that JHU added or rewrote are read and parsed again.
+
+    git_dir = run_git(git_root, "rev-parse", "--absolute-git-dir").decode().strip()
+    cache_filename = os.path.join(git_dir, "covid-chart-blob-cache.pickle")
+    try:
+        with open(cache_filename, "rb") as cache_file_obj:
+            saved = pickle.load(cache_file_obj)
+        cache = saved["blobs"] if saved.get("version") == JHU_BLOB_CACHE_VERSION else {}
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, KeyError):
+        cache = {}
+
+    # git ls-tree -z output: "<mode> blob <sha>\t<path>\0" for each report
+    reports = []
+    tree = run_git(git_root, "ls-tree", "-z", "HEAD", JHU_REPORTS_DIR + "/").decode()
+    for entry in filter(None, tree.split("\0")):
+        info, path = entry.split("\t", 1)
+        mode, object_type, sha = info.split()
+        file_name = os.path.basename(path)
+        if object_type == "blob" and file_name.endswith(".csv") and get_report_date_str(file_name):
+            reports.append((get_report_date_str(file_name), sha))
+    reports.sort()
+
+    missing = [sha for date_str, sha in reports if sha not in cache]
+    if missing:
+        print("reading %d of %d reports from git" % (len(missing), len(reports)))
+        batch = subprocess.Popen(
+            ["git", "-C", git_root, "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        shas_to_dates = {sha: date_str for date_str, sha in reports}
+        for sha in missing:
+            # One object at a time: git flushes each object, so the pipes never fill up.
+            batch.stdin.write(("%s\n" % sha).encode())
+            batch.stdin.flush()
+            object_sha, object_type, size = batch.stdout.readline().decode().split()
+            blob = batch.stdout.read(int(size))
+            batch.stdout.read(1)  # newline after the contents
+            if debug:
+                print("ingesting blob %s (%s)" % (sha, shas_to_dates[sha]))
+            date_str = shas_to_dates[sha]
+            blob_results = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+            # Same text handling as open() in get_jhu_data.
+            ingest_jhu_report(io.TextIOWrapper(io.BytesIO(blob)), date_str, blob_results)
+            cache[sha] = {
+                location_key: (dates[date_str]["cases"], dates[date_str]["deaths"])
+                for location_key, dates in blob_results.items()
+            }
+        batch.stdin.close()
+        batch.wait()
+
+        # Forget reports that are no longer in the tree, and save the cache.
+        current = set(sha for date_str, sha in reports)
+        cache = {sha: counts for sha, counts in cache.items() if sha in current}
+        with open(cache_filename + ".tmp", "wb") as cache_file_obj:
+            saved = {"version": JHU_BLOB_CACHE_VERSION, "blobs": cache}
+            pickle.dump(saved, cache_file_obj, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_filename + ".tmp", cache_filename)
+
+    # store all results in the same multi-level dictionary as get_jhu_data
+    results = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    for date_str, sha in reports:
+        for location_key, (cases, deaths) in cache[sha].items():
+            results[location_key][date_str]["cases"] += cases
+            results[location_key][date_str]["deaths"] += deaths
     return results
 
 
+# source name : function that loads the JHU daily reports from a git_root
+JHU_ENGINES = {
+    "jhu": get_jhu_data,
+    "jhu-git": get_jhu_data_git,
+}
+
+# loaders that read HEAD from the git object store, so they work without a checked-out tree
+JHU_GIT_ENGINES = ("jhu-git",)
+
+
 def get_wake_data(location_key):
 
     # This POST was basically copied from the "view cases by day" graph on https://covid19.wakegov.com/